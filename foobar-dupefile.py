@@ -1,18 +1,50 @@
 import os
+import errno
+import hashlib
+import json
+import tempfile
+import queue
 import shutil
 import logging
+from logging.handlers import QueueHandler, QueueListener
+import threading
+import time
+from functools import lru_cache, partial
 from pathlib import Path
 from typing import Union
 from datetime import datetime
 from dotenv import load_dotenv
 
-def setup_logging():
+# blake3 为可选依赖，未安装时使用标准库的 blake2b 校验文件内容
+try:
+    from blake3 import blake3
+except ImportError:
+    blake3 = None
+
+def setup_logging() -> QueueListener:
+    """
+    日志记录先放入队列，由后台线程统一写入文件，避免工作线程争用文件锁
+    返回已启动的 QueueListener，处理结束后需要调用 stop() 写完剩余日志
+    """
+    # 不需要线程、进程和调用位置信息，省去每条日志的额外开销
+    logging.logThreads = False
+    logging.logProcesses = False
+    logging.logMultiprocessing = False
+    logging._srcfile = None
+    
     timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-    logging.basicConfig(
-        filename=f'file_handler_{timestamp}.log',
-        level=logging.INFO,
-        format='%(asctime)s - %(levelname)s - %(message)s'
-    )
+    file_handler = logging.FileHandler(f'file_handler_{timestamp}.log')
+    # 使用相对启动时间的毫秒数代替 asctime，省去每条日志的时间格式化；绝对时间见日志文件名
+    file_handler.setFormatter(logging.Formatter('%(relativeCreated).0f - %(levelname)s - %(message)s'))
+    
+    log_queue = queue.SimpleQueue()
+    root_logger = logging.getLogger()
+    root_logger.setLevel(logging.INFO)
+    root_logger.addHandler(QueueHandler(log_queue))
+    
+    listener = QueueListener(log_queue, file_handler)
+    listener.start()
+    return listener
 
 def load_environment():
     load_dotenv()
@@ -40,90 +72,410 @@ def load_environment():
     # 获取要处理的后缀名（不包含点号）
     target_extension = os.getenv('TARGET_EXTENSION', '').lower()
     
-    return source_path, action, target_path, handle_different_extensions, target_extension
+    # 获取扫描目录的线程数
+    scan_workers = int(os.getenv('SCAN_WORKERS', '16'))
+    
+    # 获取移动或删除文件的线程数
+    move_workers = int(os.getenv('MOVE_WORKERS', '8'))
+    
+    # 获取是否在处理前校验两个文件内容相同，默认不校验
+    verify = os.getenv('VERIFY', 'false').lower() == 'true'
+    if verify and handle_different_extensions and target_extension:
+        # 不同后缀的文件格式不同，内容不可能相同，校验会跳过所有文件对，因此只在(1)模式下校验
+        logging.warning("VERIFY is ignored when HANDLE_DIFFERENT_EXTENSIONS is enabled: "
+                        "files with different extensions never have identical content")
+        verify = False
+    
+    # 获取保存目录状态的文件路径，默认不设置，即不使用缓存，每次都完整扫描；支持 ~ 表示用户目录
+    state_file = os.getenv('STATE_FILE', '')
+    if state_file:
+        state_file = os.path.expanduser(state_file)
+    
+    return source_path, action, target_path, handle_different_extensions, target_extension, scan_workers, move_workers, verify, state_file
+
+@lru_cache(maxsize=256)
+def _norm_ext(ext: str) -> str:
+    """去掉点号并转为小写的后缀，常见后缀很少，缓存后直接复用同一个字符串"""
+    return ext[1:].lower() if ext else ''
+
+def scan_directory(dirpath: str) -> tuple[list[str], list[str]]:
+    """
+    扫描单个目录，只调用一次 os.scandir
+    返回元组：(子目录列表, 普通文件名列表)
+    """
+    subdirs = []
+    names = []
+    with os.scandir(dirpath) as it:
+        for entry in it:
+            # 直接使用目录项缓存的类型，不额外调用 stat；符号链接、管道等其他类型跳过
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry.path)
+            elif entry.is_file(follow_symlinks=False):
+                names.append(entry.name)
+    return subdirs, names
+
+# 修改时间距现在不足 2 秒的目录不写入状态（FAT 等文件系统的时间精度为 2 秒）
+STATE_MTIME_GRACE_NS = 2_000_000_000
+
+def _valid_state_entry(entry) -> bool:
+    """目录状态的每一项必须是 [修改时间(整数纳秒), [子目录名, ...]]"""
+    return (isinstance(entry, list) and len(entry) == 2
+            and isinstance(entry[0], int) and not isinstance(entry[0], bool)
+            and isinstance(entry[1], list) and all(isinstance(name, str) for name in entry[1]))
+
+def load_state(state_file: str) -> dict:
+    """
+    读取上次运行保存的目录状态，文件不存在、无法解析或格式不对时返回空字典
+    格式不对的单个目录记录会被丢弃，对应目录重新扫描
+    """
+    try:
+        with open(state_file, 'r', encoding='utf-8') as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    
+    if not isinstance(state, dict):
+        return {}
+    return {
+        key: {dirpath: entry for dirpath, entry in dirs.items() if _valid_state_entry(entry)}
+        for key, dirs in state.items()
+        if isinstance(dirs, dict)
+    }
+
+def save_state(state_file: str, state: dict):
+    """先写入同目录下的临时文件再替换，避免中途退出时留下不完整的状态文件，多个进程同时运行也不会互相覆盖临时文件"""
+    state_dir = os.path.dirname(state_file) or '.'
+    os.makedirs(state_dir, exist_ok=True)
+    tmp = tempfile.NamedTemporaryFile('w', encoding='utf-8', dir=state_dir,
+                                      prefix=os.path.basename(state_file) + '.', suffix='.tmp', delete=False)
+    try:
+        with tmp:
+            json.dump(state, tmp, ensure_ascii=False)
+        os.replace(tmp.name, state_file)
+    except BaseException:
+        os.unlink(tmp.name)
+        raise
 
-def find_duplicate_pairs(file_path: Path, handle_different_extensions: bool, target_extension: str) -> tuple[bool, Union[Path, None]]:
+def _scan_worker(dir_queue: queue.LifoQueue, on_pairs, errors: list,
+                 handle_different_extensions: bool, target_extension: str,
+                 seen: Union[dict, None], new_seen: Union[dict, None], stop: threading.Event):
+    """扫描线程：从队列取出目录，把子目录放回队列，把找到的文件对交给 on_pairs"""
+    while True:
+        dirpath = dir_queue.get()
+        try:
+            if dirpath is None:
+                return
+            # 已经出错或收到停止信号时只清空队列，不再继续扫描
+            if errors or stop.is_set():
+                continue
+            
+            # 与 os.walk 一致，无法读取的目录（权限不足、已被删除等）记录警告后跳过，不中断整个处理
+            try:
+                if seen is not None:
+                    # 目录的修改时间在增删、重命名子项时会更新，没有变化说明上次记录的结果仍然有效
+                    mtime = os.stat(dirpath).st_mtime_ns
+                    cached = seen.get(dirpath)
+                    if cached and cached[0] == mtime:
+                        new_seen[dirpath] = cached
+                        for name in cached[1]:
+                            dir_queue.put(os.path.join(dirpath, name))
+                        continue
+                
+                subdirs, names = scan_directory(dirpath)
+            except OSError as e:
+                logging.warning(f"Skipped unreadable directory {dirpath}: {str(e)}")
+                continue
+            
+            for subdir in subdirs:
+                dir_queue.put(subdir)
+            pairs = find_duplicate_pairs(dirpath, names, handle_different_extensions, target_extension)
+            if pairs:
+                on_pairs(dirpath, pairs)
+            elif seen is not None and time.time_ns() - mtime > STATE_MTIME_GRACE_NS:
+                # 只记录没有需要处理的文件对的目录，以及它的子目录名
+                # 刚修改过的目录不记录，避免同一时间精度内的后续修改被漏掉
+                new_seen[dirpath] = [mtime, [os.path.basename(subdir) for subdir in subdirs]]
+        except Exception as e:
+            errors.append(e)
+            # 通知其他扫描线程和处理线程停止
+            stop.set()
+        finally:
+            dir_queue.task_done()
+
+def scan_directories(top: str, handle_different_extensions: bool, target_extension: str, workers: int, on_pairs,
+                     seen: Union[dict, None] = None, stop: Union[threading.Event, None] = None) -> Union[dict, None]:
     """
-    检查文件是否有同名但不同后缀的文件
-    返回元组：(是否找到同名文件, 另一个文件的路径如果存在)
+    使用多个线程并行遍历目录树
+    每个目录扫描完成后，在扫描线程中调用 on_pairs(目录路径, [(要处理的原始文件, 要保留的文件), ...])
+    传入上次的目录状态 seen 时，修改时间未变的目录不再扫描，返回本次运行的目录状态
+    stop 被设置后不再扫描剩余目录
     """
-    name = file_path.stem
-    suffix = file_path.suffix.lower()[1:]  # 去掉点号的后缀
-    parent = file_path.parent
+    if stop is None:
+        stop = threading.Event()
+    dir_queue = queue.LifoQueue()
+    errors = []
+    new_seen = {} if seen is not None else None
+    dir_queue.put(top)
+    
+    threads = [
+        threading.Thread(target=_scan_worker, daemon=True,
+                         args=(dir_queue, on_pairs, errors, handle_different_extensions, target_extension,
+                               seen, new_seen, stop))
+        for _ in range(max(1, workers))
+    ]
+    for thread in threads:
+        thread.start()
     
+    # 等待所有目录扫描完成后通知线程退出
+    dir_queue.join()
+    for _ in threads:
+        dir_queue.put(None)
+    for thread in threads:
+        thread.join()
+    
+    if errors:
+        raise errors[0]
+    return new_seen
+
+def find_duplicate_pairs(dir_path: str, names: list[str], handle_different_extensions: bool, target_extension: str) -> list[tuple[Path, Path]]:
+    """
+    在单个目录的文件名列表中查找需要处理的文件对，只对找到的文件对构造 Path
+    返回列表：[(要处理的原始文件, 要保留的文件), ...]
+    """
+    pairs = []
     if handle_different_extensions and target_extension:
-        # 只处理目标后缀的文件
-        if suffix == target_extension:
+        # 先按后缀过滤：目标后缀的文件按主干分组，其他文件只记录每个主干的第一个
+        targets = {}
+        others = {}
+        for name in names:
+            stem, ext = os.path.splitext(name)
+            # 带(1)的文件不需要处理，直接跳过，不再分组
+            if stem.endswith(' (1)'):
+                continue
+            if _norm_ext(ext) == target_extension:
+                targets.setdefault(stem, []).append(name)
+            else:
+                others.setdefault(stem, name)
+        
+        for stem, group in targets.items():
             # 查找同名但后缀不同的文件
-            for other_file in parent.iterdir():
-                if other_file.stem == name and other_file.suffix.lower()[1:] != target_extension:
-                    return True, other_file
+            other = others.get(stem)
+            if other is None:
+                continue
+            # 只处理目标后缀的文件
+            for name in group:
+                pairs.append((Path(os.path.join(dir_path, name)), Path(os.path.join(dir_path, other))))
     else:
         # 原有逻辑，匹配带(1)的文件
-        duplicate_name = f"{name} (1){file_path.suffix}"
-        duplicate_path = parent / duplicate_name
-        if duplicate_path.exists():
-            return True, duplicate_path
+        # 从带(1)的文件反推原始文件名，大部分文件不带(1)，只需一次 endswith 判断
+        names_set = set(names)
+        for duplicate_name in names:
+            stem, ext = os.path.splitext(duplicate_name)
+            if not stem.endswith(' (1)'):
+                continue
+            original_stem = stem.removesuffix(' (1)')
+            # 原始文件本身带(1)时不处理
+            if original_stem.endswith(' (1)'):
+                continue
+            name = original_stem + ext
+            # 拼出的文件名要能拆回同样的主干和后缀（例如 " (1).mp3" 不对应 ".mp3"）
+            if name in names_set and os.path.splitext(name) == (original_stem, ext):
+                pairs.append((Path(os.path.join(dir_path, name)), Path(os.path.join(dir_path, duplicate_name))))
+    return pairs
+
+def move_file(src: str, dst: str):
+    """同一文件系统内直接原子重命名，跨文件系统时退回 shutil.move"""
+    try:
+        os.replace(src, dst)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        shutil.move(src, dst)
+
+@lru_cache(maxsize=1024)
+def get_target_prefix(dir_path: str, source_root: Path, target_root: Path) -> str:
+    """
+    计算源目录在归档目录中的对应位置，保持与源目录相同的目录结构
+    返回以路径分隔符结尾的字符串，同一目录只计算一次，直接拼接文件名即可得到目标路径
+    """
+    relative_path = Path(dir_path).relative_to(source_root)
+    return os.fspath(target_root / relative_path) + os.sep
+
+def _handle_delete(file_path: Path, duplicate_path: Path):
+    """删除原始文件，保留(1)版本"""
+    try:
+        file_path.unlink()
+        logging.info(f"Deleted original file: {file_path}")
+        logging.info(f"Kept file: {duplicate_path}")
     
-    return False, None
+    except Exception as e:
+        logging.error(f"Error handling file {file_path}: {str(e)}")
+        raise
 
-def handle_file(file_path: Path, duplicate_path: Path, action: str, target_path: Union[str, None]):
-    """处理原始文件并重命名(1)版本"""
+def _handle_move(file_path: Path, duplicate_path: Path, source_root: Path, target_root: Path):
+    """移动原始文件到归档目录，保留(1)版本"""
     try:
-        if action == 'delete':
-            file_path.unlink()
-            logging.info(f"Deleted original file: {file_path}")
-        else:  # move
-            if not os.path.exists(target_path):
-                os.makedirs(target_path)
-            
-            # 创建与源目录相同的目录结构
-            relative_path = file_path.parent.relative_to(Path(os.getenv('SOURCE_PATH')))
-            new_target = Path(target_path) / relative_path
-            new_target.mkdir(parents=True, exist_ok=True)
-            
-            shutil.move(str(file_path), str(new_target / file_path.name))
-            logging.info(f"Moved original file: {file_path} -> {new_target / file_path.name}")
-        
+        # 目标目录已在 process_directory 中预先创建
+        src = os.fspath(file_path)
+        dst = get_target_prefix(os.path.dirname(src), source_root, target_root) + file_path.name
+        move_file(src, dst)
+        logging.info(f"Moved original file: {file_path} -> {dst}")
         logging.info(f"Kept file: {duplicate_path}")
     
     except Exception as e:
         logging.error(f"Error handling file {file_path}: {str(e)}")
         raise
 
+def file_digest(path: str) -> bytes:
+    """计算文件内容的哈希值，优先使用 blake3（mmap 读取），否则使用 blake2b"""
+    if blake3 is not None:
+        hasher = blake3()
+        hasher.update_mmap(path)
+        return hasher.digest()
+    hasher = hashlib.blake2b()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            hasher.update(chunk)
+    return hasher.digest()
+
+def files_identical(path_a: str, path_b: str) -> bool:
+    """先比较文件大小，大小相同时再比较内容哈希"""
+    size = os.stat(path_a).st_size
+    if size != os.stat(path_b).st_size:
+        return False
+    if size == 0:
+        return True
+    return file_digest(path_a) == file_digest(path_b)
+
+def _handle_verified(file_path: Path, duplicate_path: Path, handler):
+    """只有两个文件内容相同时才交给 handler 处理，否则跳过"""
+    try:
+        identical = files_identical(os.fspath(file_path), os.fspath(duplicate_path))
+    except Exception as e:
+        logging.error(f"Error verifying file {file_path}: {str(e)}")
+        raise
+    
+    if not identical:
+        logging.info(f"Skipped file pair with different content: Original: {file_path}, Keep: {duplicate_path}")
+        return
+    handler(file_path, duplicate_path)
+
+def get_file_handler(action: str, source_root: Path, target_root: Union[Path, None], verify: bool = False):
+    """根据处理方式在启动时选定处理函数，返回 handler(原始文件, 要保留的文件)"""
+    if action == 'delete':
+        handler = _handle_delete
+    else:
+        handler = partial(_handle_move, source_root=source_root, target_root=target_root)
+    if verify:
+        handler = partial(_handle_verified, handler=handler)
+    return handler
+
+def _move_worker(pair_queue: queue.Queue, errors: list, handler, stop: threading.Event):
+    """处理线程：从队列取出文件对并处理，收到 None 时退出"""
+    while True:
+        pair = pair_queue.get()
+        try:
+            if pair is None:
+                return
+            # 已经出错或收到停止信号时只清空队列，不再处理剩余的文件对，避免扫描线程阻塞在已满的队列上
+            if stop.is_set():
+                continue
+            handler(*pair)
+        except Exception as e:
+            errors.append(e)
+            # 通知其他处理线程和扫描线程停止
+            stop.set()
+        finally:
+            pair_queue.task_done()
+
 def process_directory():
     """主处理函数"""
-    setup_logging()
+    listener = setup_logging()
     logging.info("Starting file processing")
     
     try:
         # 加载环境变量
-        source_path, action, target_path, handle_different_extensions, target_extension = load_environment()
+        source_path, action, target_path, handle_different_extensions, target_extension, scan_workers, move_workers, verify, state_file = load_environment()
         logging.info(f"Configuration loaded - Source: {source_path}, Action: {action}, "
                     f"Target: {target_path}, Handle Different Extensions: {handle_different_extensions}, "
-                    f"Target Extension: {target_extension}")
+                    f"Target Extension: {target_extension}, Scan Workers: {scan_workers}, Move Workers: {move_workers}, Verify: {verify}, "
+                    f"State File: {state_file}")
+        
+        # 只构造一次根目录的 Path，避免每个文件重复读取环境变量
+        source_root = Path(source_path)
+        target_root = Path(target_path) if target_path else None
+        
+        # 处理开始前只创建一次目标根目录，处理线程不再逐个文件检查
+        # 已创建的目标目录记录在集合中，同一目录不会重复调用 makedirs
+        created_dirs = set()
+        if action == 'move':
+            os.makedirs(target_root, exist_ok=True)
+            created_dirs.add(os.fspath(target_root) + os.sep)
+        
+        # 扫描和处理同时进行：扫描线程把文件对放入队列，处理线程从队列取出并处理
+        pair_queue = queue.Queue(maxsize=1024)
+        move_errors = []
+        stop = threading.Event()
+        handler = get_file_handler(action, source_root, target_root, verify)
+        movers = [
+            threading.Thread(target=_move_worker, daemon=True,
+                             args=(pair_queue, move_errors, handler, stop))
+            for _ in range(max(1, move_workers))
+        ]
+        for mover in movers:
+            mover.start()
+        
+        def on_pairs(dirpath: str, pairs: list[tuple[Path, Path]]):
+            # 处理线程已经出错时不再创建目标目录，也不再放入文件对
+            if stop.is_set():
+                return
+            # 每个目录只由一个扫描线程处理，先创建好目标目录再放入队列，处理线程只负责移动或删除
+            if action == 'move':
+                new_target = get_target_prefix(dirpath, source_root, target_root)
+                if new_target not in created_dirs:
+                    os.makedirs(new_target, exist_ok=True)
+                    created_dirs.add(new_target)
+            for file_path, duplicate_path in pairs:
+                logging.info(f"Found file pair: Original: {file_path}, Keep: {duplicate_path}")
+                pair_queue.put((file_path, duplicate_path))
+        
+        # 读取上次运行的目录状态，按源目录和匹配方式分别保存
+        state = load_state(state_file) if state_file else None
+        if handle_different_extensions and target_extension:
+            state_key = f"{source_path}|extension:{target_extension}"
+        else:
+            state_key = f"{source_path}|duplicate"
+        seen = state.get(state_key, {}) if state is not None else None
+        
+        try:
+            seen = scan_directories(source_path, handle_different_extensions, target_extension, scan_workers, on_pairs, seen, stop)
+        except BaseException:
+            # 扫描出错或被中断（Ctrl-C）时先发出停止信号，队列中剩余的文件对只清空不处理
+            stop.set()
+            raise
+        finally:
+            # 扫描结束（或出错）后通知处理线程退出
+            for _ in movers:
+                pair_queue.put(None)
+            for mover in movers:
+                mover.join()
+        
+        if move_errors:
+            raise move_errors[0]
         
-        # 收集所有需要处理的文件
-        files_to_process = []
-        for root, _, files in os.walk(source_path):
-            for file in files:
-                file_path = Path(root) / file
-                # 只处理不带(1)的文件
-                if not file_path.stem.endswith(' (1)'):
-                    has_duplicate, duplicate_path = find_duplicate_pairs(file_path, handle_different_extensions, target_extension)
-                    if has_duplicate:
-                        files_to_process.append((file_path, duplicate_path))
-                        logging.info(f"Found file pair: Original: {file_path}, Keep: {duplicate_path}")
+        if state is not None:
+            state[state_key] = seen
+            save_state(state_file, state)
         
-        # 处理收集到的文件
-        for original_path, duplicate_path in files_to_process:
-            handle_file(original_path, duplicate_path, action, target_path)
+        logging.info("File processing completed")
     
     except Exception as e:
         logging.error(f"Error during processing: {str(e)}")
         raise
     
-    logging.info("File processing completed")
+    finally:
+        # 等待后台线程写完队列中剩余的日志
+        listener.stop()
 
 if __name__ == "__main__":
     process_directory()